@@ -1,144 +1,395 @@
+import asyncio
+import functools
+import inspect
+import logging
+import os
+import time
+import uuid
+import weakref
 import httpx
+import orjson
+from collections import OrderedDict, defaultdict
+from contextlib import asynccontextmanager
+from operator import add
 from typing import TypedDict, Optional, List, Annotated
 from langgraph.graph import StateGraph, START, END
 from langgraph.types import Command, interrupt
 from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 
-# --- HELPER: REDUCER ---
-def replace(old_value, new_value):
-    return new_value
+logger = logging.getLogger(__name__)
 
 # --- 1. STATE DEFINITION (Robust) ---
+# Plain fields are last-write-wins (no reducer call); only the accumulating lists use `add`.
 class InvoiceState(TypedDict):
-    invoice_file: Annotated[str, replace]
-    invoice_id: Annotated[str, replace]
-    ocr_text: Annotated[str, replace]
-    extracted_data: Annotated[dict, replace]
-    vendor_profile: Annotated[dict, replace]
-    po_data: Annotated[Optional[dict], replace]
-    match_score: Annotated[float, replace]
-    accounting_entries: Annotated[list, replace]
-    approval_status: Annotated[str, replace]
-    erp_txn_id: Annotated[str, replace]
-    logs: Annotated[List[str], replace]
-    status: Annotated[str, replace]
-    review_url: Annotated[Optional[str], replace]
-    flags: Annotated[List[str], replace]
+    invoice_file: str
+    invoice_id: str
+    ocr_tool: str
+    ocr_text: str
+    extracted_data: dict
+    vendor: str
+    amount: float
+    vendor_profile: dict
+    po_data: Optional[dict]
+    match_score: float
+    accounting_entries: list
+    approval_status: str
+    erp_txn_id: str
+    notification: dict
+    logs: Annotated[List[str], add]
+    status: str
+    review_url: Optional[str]
+    error: Optional[str]
+    flags: Annotated[List[str], add]
 
 # --- 2. BIGTOOL PICKER (Heuristic V1) ---
+# Capability rules are static, so they are resolved through lookup tables built once at import.
+_IMG_EXTS = frozenset(("png", "jpg", "jpeg", "tif", "tiff"))
+
+def _pick_ocr(context: dict) -> str:
+    _, dot, ext = context.get("filename", "").rpartition(".")
+    ext = ext.lower() if dot else ""
+    return "google_vision" if ext in _IMG_EXTS else "aws_textract" if ext == "pdf" else "tesseract"
+
+def _pick_enrichment(context: dict) -> str:
+    return "clearbit" if "CORP" in context.get("vendor", "").upper() else "people_data_labs"
+
+_CAP_DISPATCH = {
+    "ocr": _pick_ocr,
+    "enrichment": _pick_enrichment,
+    "erp": lambda context: "sap_connector",
+}
+
 class BigToolPicker:
     @staticmethod
     def select(capability: str, context: dict = None) -> str:
-        context = context or {}
-        # 1. OCR Selection Logic
-        if capability == "ocr":
-            filename = context.get("filename", "").lower()
-            if filename.endswith(".png") or filename.endswith(".jpg"):
-                return "google_vision"
-            elif filename.endswith(".pdf"):
-                return "aws_textract"
-            else:
-                return "tesseract"
-            
-        # 2. Enrichment Selection Logic
-        if capability == "enrichment":
-            vendor = context.get("vendor", "").upper()
-            if "CORP" in vendor:
-                return "clearbit"
-            else:
-                return "people_data_labs"
-            
-        # 3. ERP Selection Logic
-        if capability == "erp":
-            return "sap_connector"
-        
-        return "default_tool"
+        try:
+            pick = _CAP_DISPATCH[capability]
+        except KeyError:
+            # Fail fast: a placeholder tool name would only fail later, at the server call
+            raise ValueError(f"No tool registered for capability {capability!r}") from None
+        return pick(context or {})
 
 # --- 3. HELPERS ---
 COMMON_URL = "http://127.0.0.1:8001"
 ATLAS_URL = "http://127.0.0.1:8002"
 
-def call_post(url, endpoint, json=None, params=None):
-    try: return httpx.post(f"{url}/{endpoint}", json=json, params=params).json()
-    except: return {}
+# Invoices processed concurrently by process_many; PREPARE and POSTING each fan out
+# two calls per invoice, so the pool allows two connections per in-flight invoice.
+MAX_CONCURRENCY = 32
+
+# Shared pooled client: keep-alive connections to COMMON/ATLAS are reused across nodes and invoices.
+# Idle connections are dropped before the servers' keep-alive timeout, so a pooled socket is
+# never reused just as the server closes it.
+KEEPALIVE_EXPIRY = 20.0
+
+# An AsyncClient's pool is bound to the loop that first used it, so there is one client per
+# running loop (repeated asyncio.run calls, app lifespans), created on first use.
+_clients = weakref.WeakKeyDictionary()  # event loop -> httpx.AsyncClient
+
+def get_client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        client = _clients[loop] = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_keepalive_connections=MAX_CONCURRENCY,
+                max_connections=MAX_CONCURRENCY * 2,
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            ),
+            timeout=5.0,
+        )
+    return client
+
+_JSON_HEADERS = {"content-type": "application/json"}
+
+class TransientServerError(Exception):
+    """A COMMON/ATLAS call failed at the transport or HTTP-status level."""
+
+async def _post(client: httpx.AsyncClient, url, json=None, params=None) -> httpx.Response:
+    # orjson encodes straight to bytes; responses are decoded with orjson.loads(r.content)
+    if json is None:
+        return await client.post(url, params=params)
+    return await client.post(url, content=orjson.dumps(json), params=params, headers=_JSON_HEADERS)
+
+class BatchingClient:
+    """Coalesces same-endpoint POSTs from concurrent invoices into one `/{endpoint}/batch` call.
+
+    Adaptive: while nothing is in flight for an endpoint the queue is flushed on the next
+    loop tick, so a lone invoice pays no extra latency. While a batch is in flight, new
+    items accumulate for up to `window` seconds or until `max_batch` items are queued.
+    The server answers `{"items": [...]}` with `{"results": [...]}` in the same order, each
+    result being `{"result": ...}` or `{"error": "..."}`, so one bad item only fails its own caller.
+    """
+    def __init__(self, get_client, window: float = 0.02, max_batch: int = 32):
+        self._get_client = get_client
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = {}  # (url, endpoint) -> [(payload, json, params, future)]
+        self._timers = {}
+        self._inflight = defaultdict(int)
+        self._tasks = set()  # strong refs: the loop only keeps weak ones to running tasks
+
+    async def post(self, url, endpoint, json=None, params=None):
+        key = (url, endpoint)
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        queue = self._pending.setdefault(key, [])
+        queue.append((json if json is not None else params, json, params, fut))
+        if len(queue) >= self.max_batch:
+            self._flush(key)
+        elif key not in self._timers:
+            delay = self.window if self._inflight[key] else 0
+            self._timers[key] = loop.call_later(delay, self._flush, key)
+        return await fut
+
+    def _flush(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(key, None)
+        if batch:
+            self._inflight[key] += 1
+            task = asyncio.ensure_future(self._send(key, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, key, batch):
+        url, endpoint = key
+        client = self._get_client()
+        try:
+            if len(batch) == 1:
+                _, json, params, _ = batch[0]
+                r = await _post(client, f"{url}/{endpoint}", json=json, params=params)
+                r.raise_for_status()
+                outcomes = [(orjson.loads(r.content), None)]
+            else:
+                r = await _post(client, f"{url}/{endpoint}/batch", json={"items": [item[0] for item in batch]})
+                r.raise_for_status()
+                body = orjson.loads(r.content)
+                results = body.get("results") if isinstance(body, dict) else None
+                if not isinstance(results, list) or len(results) != len(batch):
+                    raise TransientServerError(f"{endpoint}/batch: malformed response")
+                outcomes = [self._unwrap(endpoint, res) for res in results]
+        except Exception as e:
+            for *_, fut in batch:
+                if not fut.done(): fut.set_exception(e)
+        else:
+            for (*_, fut), (res, err) in zip(batch, outcomes):
+                if fut.done():
+                    continue
+                if err is not None:
+                    fut.set_exception(err)
+                else:
+                    fut.set_result(res)
+        finally:
+            self._inflight[key] -= 1
+            # Items that queued up behind this batch go out as soon as it returns
+            if key in self._pending:
+                self._flush(key)
 
-def call_get(url, endpoint, params=None):
-    try: return httpx.get(f"{url}/{endpoint}", params=params).json()
-    except: return {}
+    @staticmethod
+    def _unwrap(endpoint, res):
+        """Splits one `{"result"}`/`{"error"}` batch entry into (result, exception)."""
+        if isinstance(res, dict) and "result" in res:
+            return res["result"], None
+        reason = res.get("error") if isinstance(res, dict) else None
+        return None, TransientServerError(f"{endpoint}: {reason or 'malformed batch item'}")
+
+_batcher = BatchingClient(get_client)
+
+# Deterministic, side-effect free endpoints that the servers also expose as `/batch`
+_BATCHABLE = {COMMON_URL: frozenset({"parse_invoice", "compute_match_score", "build_accounting_entries"})}
+
+# LOCAL_MODE=1 runs the COMMON/ATLAS tools in-process instead of over HTTP loopback
+# (single-host deploys); the HTTP path stays the default for remote servers.
+LOCAL_MODE = os.getenv("LOCAL_MODE") == "1"
+
+async def _call_local(endpoint, payload):
+    from servers import LOCAL_HANDLERS  # imported lazily: it initialises the ERP db
+    # Sync handlers may block (simulated latency, sqlite), so run them off the loop;
+    # async ones (ocr_extract) hand back a coroutine that is awaited here instead
+    try:
+        result = await asyncio.to_thread(LOCAL_HANDLERS[endpoint], payload or {})
+        if inspect.isawaitable(result):
+            result = await result
+    except Exception as e:
+        # Same contract as over HTTP, where a failing handler surfaces as a 5xx
+        raise TransientServerError(f"{endpoint}: {type(e).__name__}: {e}") from e
+    return result
+
+async def call_post(url, endpoint, json=None, params=None):
+    if LOCAL_MODE:
+        return await _call_local(endpoint, json if json is not None else params)
+    try:
+        if endpoint in _BATCHABLE.get(url, ()):
+            return await _batcher.post(url, endpoint, json=json, params=params)
+        r = await _post(get_client(), f"{url}/{endpoint}", json=json, params=params)
+        r.raise_for_status()
+        return orjson.loads(r.content)
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+        raise TransientServerError(f"{endpoint}: {e}") from e
+
+async def call_get(url, endpoint, params=None):
+    if LOCAL_MODE:
+        return await _call_local(endpoint, params)
+    try:
+        r = await get_client().get(f"{url}/{endpoint}", params=params)
+        r.raise_for_status()
+        return orjson.loads(r.content)
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+        raise TransientServerError(f"{endpoint}: {e}") from e
+
+async def aclose_client():
+    """Closes the running loop's client; the next call on this loop opens a fresh one."""
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+class _AsyncTTLCache:
+    """Bounded LRU+TTL cache for async lookups.
+
+    Concurrent misses on the same key share one in-flight request (singleflight).
+    Failed responses, and results rejected by `cacheable` (default: empty ones), are
+    never cached.
+    """
+    def __init__(self, maxsize: int, ttl: float, cacheable=bool):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.cacheable = cacheable
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._inflight = {}
+
+    async def get(self, key, fetch):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            return entry[1]
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fetch())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._settle(key, t))
+        # shield: one cancelled caller must not cancel the lookup for everyone else
+        return await asyncio.shield(task)
+
+    def _settle(self, key, task):
+        self._inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None or not self.cacheable(task.result()):
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, task.result())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def cache_clear(self):
+        self._entries.clear()
+
+# Vendor profiles are stable; PO data is more volatile, so it gets a shorter TTL
+# (matching the max-age ATLAS sends on /fetch_po). Misses are not cached, so a PO
+# entered into the ERP is picked up by the next invoice instead of after the TTL.
+_vendor_cache = _AsyncTTLCache(maxsize=512, ttl=300)
+_po_cache = _AsyncTTLCache(maxsize=512, ttl=30, cacheable=lambda res: bool(res and res.get("found")))
+
+async def enrich_vendor_cached(vendor: str) -> dict:
+    return await _vendor_cache.get(vendor, lambda: call_post(ATLAS_URL, "enrich_vendor", params={"vendor_name": vendor}))
+
+async def fetch_po_cached(vendor: str) -> dict:
+    return await _po_cache.get(vendor, lambda: call_get(ATLAS_URL, "fetch_po", params={"vendor": vendor}))
+
+def cache_clear():
+    _vendor_cache.cache_clear()
+    _po_cache.cache_clear()
 
 # --- 4. NODES ---
+# Nodes return only the keys they change; `logs`/`flags` carry just the new entries,
+# which the `add` reducer appends, so each checkpoint step stores a delta.
 
-def node_intake(state: InvoiceState):
-    state['logs'].append(f"📥 STAGE 1: Validating {state['invoice_file']}")
+async def node_intake(state: InvoiceState):
+    logs = [f"📥 STAGE 1: Validating {state['invoice_file']}"]
     if not state['invoice_file']: raise ValueError("Missing File")
-    return state
-
-def node_understand(state: InvoiceState):
-    tool = BigToolPicker.select("ocr", context={"filename": state["invoice_file"]})
-    state["logs"].append(f"🧠 STAGE 2: Heuristic selected '{tool}'")
-    ocr_res = call_post(ATLAS_URL, "ocr_extract", params={"filename": state["invoice_file"], "tool": tool})
-    state["ocr_text"] = ocr_res.get("text", "")
-    parse_res = call_post(COMMON_URL, "parse_invoice", params={"text": state["ocr_text"]})
-    state["extracted_data"] = parse_res
-    state["logs"].append(f"   -> Extracted: ${parse_res.get('amount')}")
-    return state
-
-def node_prepare(state: InvoiceState):
-    vendor = state["extracted_data"].get("vendor", "unknown")
+    # The OCR backend depends only on the filename, so resolve it once here
+    ocr_tool = BigToolPicker.select("ocr", context={"filename": state["invoice_file"]})
+    return {"ocr_tool": ocr_tool, "logs": logs}
+
+async def node_understand(state: InvoiceState):
+    tool = state["ocr_tool"]
+    logs = [f"🧠 STAGE 2: Heuristic selected '{tool}'"]
+    ocr_res = await call_post(ATLAS_URL, "ocr_extract", params={"filename": state["invoice_file"], "tool": tool})
+    ocr_text = ocr_res["text"]
+    parse_res = await call_post(COMMON_URL, "parse_invoice", params={"text": ocr_text})
+    logs.append(f"   -> Extracted: ${parse_res['amount']}")
+    # Normalised once here so downstream stages read plain top-level keys
+    return {
+        "ocr_text": ocr_text,
+        "extracted_data": parse_res,
+        "vendor": parse_res["vendor"],
+        "amount": float(parse_res["amount"]),
+        "logs": logs,
+    }
+
+async def node_prepare(state: InvoiceState):
+    vendor = state["vendor"]
     tool = BigToolPicker.select("enrichment", context={"vendor": vendor})
-    state["logs"].append(f"🛠️ STAGE 3: Selected '{tool}' for enrichment.")
-
-    # 2. Call the Mock Server
-    profile = call_post(ATLAS_URL, "enrich_vendor", params={"vendor_name": vendor})
-    state["vendor_profile"] = profile
+    logs = [f"🛠️ STAGE 3: Selected '{tool}' for enrichment."]
+
+    # 2. Call the Mock Server. The PO lookup only needs the vendor too, so it is
+    #    prefetched concurrently here and RETRIEVE just reads the result from state.
+    profile, po_res = await asyncio.gather(
+        enrich_vendor_cached(vendor),
+        fetch_po_cached(vendor),
+    )
     
     # 3. COMPUTE FLAGS (The New Logic)
     flags = []
-    score = profile.get("credit_score", 0)
+    score = profile["credit_score"]
     
-    state["logs"].append(f"   -> Vendor Score: {score} ({profile.get('risk_level')})")
+    logs.append(f"   -> Vendor Score: {score} ({profile['risk_level']})")
 
     if score < 600:
         flags.append("RISK_LOW_CREDIT_SCORE")
-    if profile.get("risk_level") == "HIGH":
+    if profile["risk_level"] == "HIGH":
         flags.append("RISK_CATEGORY_HIGH")
-        
-    # Save flags to state
-    state["flags"] = flags
     
     if flags:
-        state["logs"].append(f"   ⚠️ FLAGS DETECTED: {', '.join(flags)}")
-
-    return state
-
-def node_retrieve(state: InvoiceState):
-    state["logs"].append("📚 STAGE 4: Fetching POs...")
-    vendor = state["extracted_data"].get("vendor", "unknown")
-    po_res = call_get(ATLAS_URL, "fetch_po", params={"vendor": vendor})
-    if po_res.get("found"):
-        state["po_data"] = po_res
-        state["logs"].append(f"   -> Found PO: {po_res['po_number']}")
+        logs.append(f"   ⚠️ FLAGS DETECTED: {', '.join(flags)}")
+
+    return {
+        "vendor_profile": profile,
+        "po_data": po_res if po_res["found"] else None,
+        "flags": flags,
+        "logs": logs,
+    }
+
+async def node_retrieve(state: InvoiceState):
+    # PO was prefetched alongside vendor enrichment in PREPARE
+    po_res = state["po_data"]
+    if po_res:
+        found = f"   -> Found PO: {po_res['po_number']}"
     else:
-        state["po_data"] = None
-        state["logs"].append("   -> No PO found.")
-    return state
-
-def node_match(state: InvoiceState):
-    state["logs"].append("⚖️ STAGE 5: Matching...")
-    inv_amt = state["extracted_data"].get("amount", 0)   
-    po_amt = state["po_data"]["amount"] if state["po_data"] else 0
-    match_res = call_post(COMMON_URL, "compute_match_score", json={"invoice_amount": inv_amt, "po_amount": po_amt})
-    state["match_score"] = match_res.get("score", 0)
-    state["logs"].append(f"   -> Match Score: {state['match_score']}")
-    return state
-
-def node_checkpoint_hitl(state: InvoiceState):
-    state["logs"].append("⏸️ STAGE 6: Pausing for Human Review.")
-    state["review_url"] = f"http://internal/review/{state['invoice_id']}"
-    return state
-
-def node_hitl_decision(state: InvoiceState):
-    state["logs"].append("👨‍💼 STAGE 7 [DECISION]: Waiting for user...")
+        found = "   -> No PO found."
+    return {"logs": ["📚 STAGE 4: Fetching POs...", found]}
+
+async def node_match(state: InvoiceState):
+    # Routes itself: the score is already in hand, so no router has to read it back from state
+    # No PO means the server would score 0.0 anyway, so skip the round-trip
+    if not state["po_data"]:
+        return Command(update={"match_score": 0.0, "logs": ["⚖️ STAGE 5: Matching...", "   -> No PO -> Match Score: 0.0"]},
+                       goto=_HITL)
+    inv_amt = state["amount"]
+    po_amt = state["po_data"]["amount"]
+    match_res = await call_post(COMMON_URL, "compute_match_score", json={"invoice_amount": inv_amt, "po_amount": po_amt})
+    score = match_res["score"]
+    return Command(update={"match_score": score, "logs": ["⚖️ STAGE 5: Matching...", f"   -> Match Score: {score}"]},
+                   goto=_RECONCILE if score >= 0.90 else _HITL)
+
+async def node_checkpoint_hitl(state: InvoiceState):
+    return {
+        "review_url": f"http://internal/review/{state['invoice_id']}",
+        "logs": ["⏸️ STAGE 6: Pausing for Human Review."],
+    }
+
+async def node_hitl_decision(state: InvoiceState):
     decision = interrupt({
         "msg": "Review Needed",
         "score": state["match_score"]
@@ -146,55 +397,87 @@ def node_hitl_decision(state: InvoiceState):
     
     action = decision.get("action")
     note = decision.get("note", "")
-    state["logs"].append(f" -> User Decision: {action} ({note})")
 
-    if action == "REJECT":
-        state["status"] = "REJECTED"
-    else:
-        state["status"] = "APPROVED"
-    
-    return state
+    return {
+        "status": "REJECTED" if action == "REJECT" else "APPROVED",
+        "logs": ["👨‍💼 STAGE 7 [DECISION]: Waiting for user...", f" -> User Decision: {action} ({note})"],
+    }
 
-def node_reconcile(state: InvoiceState):
-    state["logs"].append("📘 STAGE 8: Reconciling...")
-    res = call_post(COMMON_URL, "build_accounting_entries", params={"amount": state["extracted_data"]["amount"], "vendor": state["extracted_data"]["vendor"]})
-    state["accounting_entries"] = res.get("entries", [])
-    return state
+async def node_reconcile(state: InvoiceState):
+    res = await call_post(COMMON_URL, "build_accounting_entries", params={"amount": state["amount"], "vendor": state["vendor"]})
+    return {"accounting_entries": res["entries"], "logs": ["📘 STAGE 8: Reconciling..."]}
 
-def node_approve(state: InvoiceState):
-    state["logs"].append("🔄 STAGE 9: Approving...")
+async def node_approve(state: InvoiceState):
     # Logic: If status is already "APPROVED" (from HITL node), mark as HUMAN.
     # Otherwise (if it came straight from Match), mark as AUTO.
     
     if state.get("status") == "APPROVED":
-        state["approval_status"] = "HUMAN_APPROVED"
+        approval_status = "HUMAN_APPROVED"
     else:
-        state["approval_status"] = "AUTO_APPROVED"
+        approval_status = "AUTO_APPROVED"
         
-    state["logs"].append(f"   -> Final Decision: {state['approval_status']}")
-    return state
-
-def node_posting(state: InvoiceState):
-    state["logs"].append("🏃 STAGE 10: Posting to ERP...")
-    res = call_post(ATLAS_URL, "post_to_erp", params={"invoice_id": state["invoice_id"]})
-
-    # DEBUG PRINT: Watch your terminal when this runs!
-    print(f"🔍 DEBUG: ERP Response for {state['invoice_id']}: {res}")
-
-    # Use a fallback if the ID is missing
-    state["erp_txn_id"] = res.get("erp_txn_id", "ERROR_MISSING_ID")
-    return state
-
-def node_notify(state: InvoiceState):
-    state["logs"].append("✉️ STAGE 11: Notifying...")
-    call_post(ATLAS_URL, "notify", params={"email": "vendor@acme.com", "message": "Paid"})
-    return state
-
-def node_complete(state: InvoiceState):
+    return {
+        "approval_status": approval_status,
+        "logs": ["🔄 STAGE 9: Approving...", f"   -> Final Decision: {approval_status}"],
+    }
+
+async def node_posting(state: InvoiceState):
+    # The notification doesn't depend on the ERP txn id, so it is sent concurrently
+    # with the posting and NOTIFY just records the result. It goes out before the posting
+    # is confirmed, so it only acknowledges receipt and never claims payment.
+    message = f"Invoice {state['invoice_id']} received for payment processing"
+    res, notification = await asyncio.gather(
+        call_post(ATLAS_URL, "post_to_erp", params={"invoice_id": state["invoice_id"]}),
+        call_post(ATLAS_URL, "notify", params={"email": "vendor@acme.com", "message": message}),
+        return_exceptions=True,
+    )
+    # Only a failed posting fails the stage; the posting itself must not be retried twice
+    if isinstance(res, BaseException):
+        raise res
+    # A failed notification is recorded, keeping the txn id of the successful posting
+    if isinstance(notification, TransientServerError):
+        logger.warning("Notification for %s failed: %s", state["invoice_id"], notification)
+        notification = {"status": "FAILED", "error": str(notification)}
+    elif isinstance(notification, BaseException):
+        raise notification
+
+    # Lazy %-formatting: the response dict is only rendered when DEBUG is enabled
+    logger.debug("ERP Response for %s: %s", state["invoice_id"], res)
+
+    return {
+        "erp_txn_id": res["erp_txn_id"],
+        "notification": notification,
+        "logs": ["🏃 STAGE 10: Posting to ERP..."],
+    }
+
+async def node_notify(state: InvoiceState):
+    # Notification was sent alongside the ERP posting in POSTING
+    status = state["notification"]["status"]
+    return {"logs": ["✉️ STAGE 11: Notifying...", f"   -> Notification: {status}"]}
+
+async def node_complete(state: InvoiceState):
     final_msg = "REJECTED" if state.get("status") == "REJECTED" else "SUCCESS"
-    state["logs"].append(f"✅ STAGE 12 [COMPLETE]: Workflow Finalized ({final_msg}).")
-    state["status"] = final_msg
-    return state
+    return {"status": final_msg, "logs": [f"✅ STAGE 12 [COMPLETE]: Workflow Finalized ({final_msg})."]}
+
+async def node_failure(state: InvoiceState):
+    # Single place a server failure is recorded; the failing stage only sets `error`
+    return {"status": "FAILED", "logs": [f"❌ Error: workflow stopped at {state['error']}"]}
+
+def _guarded(stage: str, node, routes_itself: bool = False):
+    """Turns a TransientServerError raised by `node` into an `error` update routed to FAILURE.
+
+    Nodes that route via Command have no outgoing edge to carry the error, so they
+    get a Command(goto=FAILURE) instead of a plain update.
+    """
+    @functools.wraps(node)
+    async def wrapper(state: InvoiceState):
+        try:
+            return await node(state)
+        except TransientServerError as e:
+            logger.warning("%s failed, routing to FAILURE: %s", stage, e)
+            update = {"error": f"{stage} ({e})"}
+            return Command(update=update, goto=_FAILURE) if routes_itself else update
+    return wrapper
 
 # --- 5. BUILD GRAPH ---
 workflow = StateGraph(InvoiceState)
@@ -203,40 +486,177 @@ nodes = [
     ("INTAKE", node_intake), ("UNDERSTAND", node_understand), ("PREPARE", node_prepare),
     ("RETRIEVE", node_retrieve), ("MATCH_TWO_WAY", node_match), ("CHECKPOINT_HITL", node_checkpoint_hitl),
     ("HITL_DECISION", node_hitl_decision), ("RECONCILE", node_reconcile), ("APPROVE", node_approve),
-    ("POSTING", node_posting), ("NOTIFY", node_notify), ("COMPLETE", node_complete)
+    ("POSTING", node_posting), ("NOTIFY", node_notify), ("COMPLETE", node_complete),
+    ("FAILURE", node_failure)
 ]
 
+# Route targets as module constants, bound as defaults so routers do a local lookup only
+_RECONCILE, _HITL, _COMPLETE, _FAILURE = "RECONCILE", "CHECKPOINT_HITL", "COMPLETE", "FAILURE"
+
+# Stages that call the COMMON/ATLAS servers and can therefore fail transiently
+_SERVER_STAGES = {"UNDERSTAND", "PREPARE", "MATCH_TWO_WAY", "RECONCILE", "POSTING"}
+# Stages that pick their successor with Command(goto=...) instead of an outgoing edge
+_COMMAND_STAGES = {"MATCH_TWO_WAY": (_RECONCILE, _HITL, _FAILURE)}
+
 for name, func in nodes:
-    workflow.add_node(name, func)
+    if name in _SERVER_STAGES:
+        func = _guarded(name, func, routes_itself=name in _COMMAND_STAGES)
+    workflow.add_node(name, func, destinations=_COMMAND_STAGES.get(name))
+
+def _then(target: str):
+    """Edge router for server stages: continue to `target` unless the stage recorded an error."""
+    def route(state, _t=target, _f=_FAILURE):
+        return _f if "error" in state else _t
+    return route
 
 workflow.add_edge(START, "INTAKE")
 workflow.add_edge("INTAKE", "UNDERSTAND")
-workflow.add_edge("UNDERSTAND", "PREPARE")
-workflow.add_edge("PREPARE", "RETRIEVE")
+workflow.add_conditional_edges("UNDERSTAND", _then("PREPARE"))
+workflow.add_conditional_edges("PREPARE", _then("RETRIEVE"))
 workflow.add_edge("RETRIEVE", "MATCH_TWO_WAY")
-
-def routing_match(state):
-    if state["match_score"] >= 0.90:
-        return "RECONCILE"
-    return "CHECKPOINT_HITL"
-
-workflow.add_conditional_edges("MATCH_TWO_WAY", routing_match)
+# MATCH_TWO_WAY has no outgoing edge: node_match returns Command(goto=RECONCILE | CHECKPOINT_HITL)
 
 workflow.add_edge("CHECKPOINT_HITL", "HITL_DECISION")
 
 # --- Conditional Router for HITL ---
-def routing_hitl(state):
-    if state["status"] == "REJECTED":
-        return "COMPLETE"
-    return "RECONCILE"
+def routing_hitl(state, _c=_COMPLETE, _r=_RECONCILE):
+    return _c if state["status"] == "REJECTED" else _r
 
 workflow.add_conditional_edges("HITL_DECISION", routing_hitl)
 
-workflow.add_edge("RECONCILE", "APPROVE")
+workflow.add_conditional_edges("RECONCILE", _then("APPROVE"))
 workflow.add_edge("APPROVE", "POSTING")
-workflow.add_edge("POSTING", "NOTIFY")
+workflow.add_conditional_edges("POSTING", _then("NOTIFY"))
 workflow.add_edge("NOTIFY", "COMPLETE")
 workflow.add_edge("COMPLETE", END)
-
-checkpointer = MemorySaver()
-app_graph = workflow.compile(checkpointer=checkpointer)
\ No newline at end of file
+workflow.add_edge("FAILURE", END)
+
+# --- 6. COMPILE ---
+_IN_MEMORY = object()
+
+def compile_app(checkpointer=_IN_MEMORY):
+    """Compiles the workflow. Defaults to an in-memory checkpointer.
+
+    Pass `checkpointer=None` for throughput runs that never pause: no state is
+    snapshotted per step, but the HITL interrupt (match score < 0.90) needs a
+    checkpointer to persist the paused thread and will fail without one.
+    """
+    if checkpointer is _IN_MEMORY:
+        checkpointer = MemorySaver()
+    return workflow.compile(checkpointer=checkpointer)
+
+@functools.cache
+def get_app_graph():
+    """Shared default graph, compiled on first use rather than at import."""
+    return compile_app()
+
+# --- 7. BULK PROCESSING ---
+async def process_many(invoices: List[dict], concurrency: int = MAX_CONCURRENCY, graph=None) -> List[tuple]:
+    """Runs many invoices through the graph concurrently, with at most `concurrency` in flight.
+
+    Each invoice is an initial state dict and runs on its own thread id. Returns
+    (thread_id, state) pairs in input order; invoices that stop for human review come
+    back paused and can be resumed on that thread id. An invoice that raises (e.g. a
+    missing file in INTAKE) comes back as its input with status "FAILED" and `error`
+    set, without affecting the others.
+    """
+    graph = graph or get_app_graph()
+    sem = asyncio.Semaphore(concurrency)
+
+    async def _one(invoice):
+        thread_id = str(uuid.uuid4())
+        try:
+            async with sem:
+                state = await graph.ainvoke(invoice, {"configurable": {"thread_id": thread_id}})
+        except Exception as e:
+            logger.exception("Invoice %s failed on thread %s", invoice.get("invoice_id"), thread_id)
+            state = {**invoice, "status": "FAILED", "error": f"{type(e).__name__}: {e}"}
+        return thread_id, state
+
+    return list(await asyncio.gather(*(_one(invoice) for invoice in invoices)))
+
+# --- 8. PERSISTENT CHECKPOINTS ---
+CHECKPOINT_DB = os.getenv("CHECKPOINT_DB", "checkpoints.db")
+CHECKPOINT_TTL = float(os.getenv("CHECKPOINT_TTL", 24 * 3600))
+# Threads paused for HITL wait on a person (weekends, holidays), so they are kept far longer
+CHECKPOINT_HITL_TTL = float(os.getenv("CHECKPOINT_HITL_TTL", 30 * 24 * 3600))
+
+_INTERRUPT_CHANNEL = "__interrupt__"  # pending write left by interrupt() on a paused thread
+
+class EvictingSqliteSaver(AsyncSqliteSaver):
+    """AsyncSqliteSaver (WAL mode) that tracks each thread's last write so stale threads can be evicted."""
+
+    async def setup(self) -> None:
+        if self.is_setup:
+            return
+        await super().setup()
+        async with self.lock:
+            await self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS thread_activity (thread_id TEXT PRIMARY KEY, updated_at REAL NOT NULL)"
+            )
+            await self.conn.commit()
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        next_config = await super().aput(config, checkpoint, metadata, new_versions)
+        async with self.lock:
+            await self.conn.execute(
+                "INSERT OR REPLACE INTO thread_activity (thread_id, updated_at) VALUES (?, ?)",
+                (str(config["configurable"]["thread_id"]), time.time()),
+            )
+            await self.conn.commit()
+        return next_config
+
+    async def _is_paused(self, thread_id: str) -> bool:
+        tup = await self.aget_tuple({"configurable": {"thread_id": thread_id, "checkpoint_ns": ""}})
+        return tup is not None and any(w[1] == _INTERRUPT_CHANNEL for w in tup.pending_writes or ())
+
+    async def evict_stale(self, max_age: float, paused_max_age: float = CHECKPOINT_HITL_TTL) -> int:
+        """Deletes threads untouched for `max_age` seconds.
+
+        Threads still paused on an interrupt (awaiting a HITL decision) are only
+        deleted once untouched for `paused_max_age` seconds.
+        """
+        await self.setup()
+        now = time.time()
+        async with self.lock:
+            async with self.conn.execute(
+                "SELECT thread_id, updated_at FROM thread_activity WHERE updated_at < ?", (now - max_age,)
+            ) as cur:
+                candidates = await cur.fetchall()
+        stale = [
+            thread_id for thread_id, updated_at in candidates
+            if updated_at < now - paused_max_age or not await self._is_paused(thread_id)
+        ]
+        for thread_id in stale:
+            await self.adelete_thread(thread_id)
+        async with self.lock:
+            await self.conn.executemany("DELETE FROM thread_activity WHERE thread_id = ?", [(t,) for t in stale])
+            await self.conn.commit()
+        return len(stale)
+
+async def _evict_periodically(saver: EvictingSqliteSaver, ttl: float, hitl_ttl: float, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            evicted = await saver.evict_stale(ttl, hitl_ttl)
+            if evicted:
+                logger.info("Evicted %d stale checkpoint threads", evicted)
+        except Exception:
+            logger.exception("Checkpoint eviction failed")
+
+@asynccontextmanager
+async def sqlite_checkpointer(path: str = CHECKPOINT_DB, ttl: float = CHECKPOINT_TTL,
+                              hitl_ttl: float = CHECKPOINT_HITL_TTL, interval: float = 300):
+    """Opens a disk-backed checkpointer and evicts threads older than `ttl` every `interval` seconds.
+
+    Threads paused for a HITL decision are kept until they are older than `hitl_ttl`.
+
+    Use ":memory:" as `path` for tests.
+    """
+    async with EvictingSqliteSaver.from_conn_string(path) as saver:
+        await saver.setup()
+        sweeper = asyncio.create_task(_evict_periodically(saver, ttl, hitl_ttl, interval))
+        try:
+            yield saver
+        finally:
+            sweeper.cancel()
@@ -1,11 +1,25 @@
 import uvicorn
 import uuid
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
 from pydantic import BaseModel
-from agent import app_graph
+from agent import compile_app, sqlite_checkpointer, aclose_client
 from langgraph.types import Command
 
-app = FastAPI(title="Langie API: Invoice Agent")
+app_graph = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global app_graph
+    # Checkpoints live on disk (SQLite, WAL) so paused HITL threads survive restarts
+    # and stale threads are evicted instead of accumulating in RAM
+    async with sqlite_checkpointer() as checkpointer:
+        app_graph = compile_app(checkpointer=checkpointer)
+        yield
+    # Release pooled keep-alive connections to the MCP servers
+    await aclose_client()
+
+app = FastAPI(title="Langie API: Invoice Agent", lifespan=lifespan)
 
 # --- DATA MODELS ---
 class StartRequest(BaseModel):
@@ -17,10 +31,27 @@ class DecisionRequest(BaseModel):
     notes: str
     reviewer_id: str = "human_user"
 
+# --- HELPERS ---
+def initial_state_for(filename: str, thread_id: str) -> dict:
+    # Only the inputs are seeded: nodes return partial updates, so every other key
+    # enters the checkpoint when the stage that owns it first writes it.
+    return {
+        "invoice_file": filename,
+        "invoice_id": f"INV-{thread_id[:4]}",
+        "status": "STARTING",
+    }
+
+def run_status(snapshot) -> str:
+    if snapshot.next:
+        return "PAUSED_HITL"
+    if snapshot.values.get("status") == "FAILED":
+        return "FAILED"
+    return "COMPLETED"
+
 # --- ENDPOINTS ---
 
 @app.post("/start")
-def start_workflow(req: StartRequest):
+async def start_workflow(req: StartRequest) -> dict:
     """
     Initiates the Invoice Processing Workflow.
     """
@@ -28,46 +59,80 @@ def start_workflow(req: StartRequest):
     config = {"configurable": {"thread_id": thread_id}}
 
     # Initialize State
-    initial_state = {
-        "invoice_file": req.filename,
-        "invoice_id": f"INV-{thread_id[:4]}",
-        "logs": [],
-        "status": "STARTING",
-        # Data placeholders
-        "ocr_text": "",
-        "extracted_data": {}, 
-        "vendor_profile": {},
-        "po_data": None,
-        "match_score": 0.0,
-        "accounting_entries": [],
-        "approval_status": "PENDING",
-        "erp_txn_id": "",
-        "review_url": ""
-    }
+    initial_state = initial_state_for(req.filename, thread_id)
 
     print(f"🚀 [API] Starting Thread: {thread_id}")
 
     # 2. Run Graph until it pauses or finishes
-    app_graph.invoke(initial_state, config=config)
+    await app_graph.ainvoke(initial_state, config=config)
 
     # 3. Check Result
-    snapshot = app_graph.get_state(config)
-    is_paused = len(snapshot.next) > 0
+    snapshot = await app_graph.aget_state(config)
 
     return {
         "thread_id": thread_id,
-        "status": "PAUSED_HITL" if is_paused else "COMPLETED", 
+        "status": run_status(snapshot),
         "logs": snapshot.values.get("logs", []),
         "state": snapshot.values
     }
 
+@app.websocket("/stream")
+async def stream_workflow(websocket: WebSocket):
+    """
+    Streaming variant of /start: the client sends {"filename": ...} and receives
+    {"thread_id"} for the new run, each log line as its stage finishes ({"log": ...}),
+    then one final {"thread_id", "status", "state"} message. A bad request or a
+    crashed run ends with {"status": "FAILED", "error"} instead.
+    """
+    # Like /start, the server mints the thread id so a client can never append to,
+    # or overwrite, an existing (possibly paused) thread
+    thread_id = str(uuid.uuid4())
+    config = {"configurable": {"thread_id": thread_id}}
+    await websocket.accept()
+    try:
+        try:
+            req = StartRequest.model_validate(await websocket.receive_json())
+        except ValueError as e:  # malformed JSON or pydantic ValidationError
+            await websocket.send_json({"status": "FAILED", "error": f"Invalid request: {e}"})
+            await websocket.close(code=1008)
+            return
+
+        print(f"🚀 [API] Streaming Thread: {thread_id}")
+        await websocket.send_json({"thread_id": thread_id})
+        try:
+            async for update in app_graph.astream(initial_state_for(req.filename, thread_id),
+                                                  config=config, stream_mode="updates"):
+                for node, delta in update.items():
+                    if node == "__interrupt__":  # HITL pause payload, not a stage update
+                        continue
+                    for line in (delta or {}).get("logs", []):
+                        await websocket.send_json({"log": line})
+        except WebSocketDisconnect:
+            raise
+        except Exception as e:
+            print(f"❌ Error Streaming {thread_id}: {e}")
+            await websocket.send_json({"thread_id": thread_id, "status": "FAILED", "error": str(e)})
+            await websocket.close(code=1011)
+            return
+
+        snapshot = await app_graph.aget_state(config)
+        await websocket.send_json({
+            "thread_id": thread_id,
+            "status": run_status(snapshot),
+            "state": snapshot.values
+        })
+        await websocket.close()
+    except WebSocketDisconnect:
+        print(f"⚠️ [API] Stream client left: {thread_id}")
+
 @app.get("/human-review/pending")
-def list_pending():
+def list_pending() -> dict:
     """
     Compliance Endpoint: Lists items waiting for review.
-    (In a real DB implementation, this queries the 'checkpoints' table)
+    (A full implementation would list the threads in the SQLite 'checkpoints' table
+    that still have a pending interrupt)
     """
-    # For this in-memory demo, we just return a placeholder to satisfy the spec contract
+    # Still a placeholder that satisfies the spec contract; paused threads are not queried yet
     return {
         "items": [
             {
@@ -79,7 +144,7 @@ def list_pending():
     }
 
 @app.post("/human-review/decision")
-def submit_decision(req:DecisionRequest):
+async def submit_decision(req:DecisionRequest) -> dict:
     """
     Resumes the workflow based on human input.
     """
@@ -91,12 +156,12 @@ def submit_decision(req:DecisionRequest):
     try:
         # Resume the graph using the Command object
         # We pass the decision data into the 'interrupt' return value
-        app_graph.invoke(
+        await app_graph.ainvoke(
             Command(resume={"action": req.decision, "note": req.notes}),
             config=config
         )
 
-        snapshot= app_graph.get_state(config)
+        snapshot= await app_graph.aget_state(config)
         final_status = snapshot.values.get("status", "unknown")
 
         return {
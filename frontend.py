@@ -1,9 +1,12 @@
 import streamlit as st
 import requests
 import time
+import json
+from websockets.sync.client import connect
 
 # Configuration
 API_URL = "http://127.0.0.1:8000"
+WS_URL = "ws://127.0.0.1:8000"
 
 st.set_page_config(page_title="Langie: Invoice Agent", layout="wide", page_icon="🧾")
 
@@ -27,6 +30,12 @@ if "status" not in st.session_state:
     st.session_state.status = "IDLE"
 if "data" not in st.session_state:
     st.session_state.data = {}
+if "pending_file" not in st.session_state:
+    st.session_state.pending_file = None
+if "http" not in st.session_state:
+    # One Session per browser session (requests.Session isn't thread-safe); reruns
+    # reuse its keep-alive connection to the API
+    st.session_state.http = requests.Session()
 
 # --- SIDEBAR: INPUT ---
 with st.sidebar:
@@ -47,22 +56,9 @@ with st.sidebar:
         st.session_state.status = "RUNNING"
         st.session_state.data = {}
 
-        with st.spinner("Initializing Agent & MCP Servers..."):
-            try:
-                # Call /start endpoint
-                resp = requests.post(f"{API_URL}/start", json={"filename": scenario})
-
-                if resp.status_code == 200:
-                    res_json = resp.json()
-                    st.session_state.thread_id = res_json["thread_id"]
-                    st.session_state.logs = res_json["logs"]
-                    st.session_state.status = res_json["status"]
-                    st.session_state.data = res_json.get("state", {})
-                else:
-                    st.error(f"API Error: {resp.text}")
-
-            except Exception as e:
-                st.error(f"Failed to connect to backend: {e}")
+        # The run itself is streamed into the log panel below; the API assigns its thread id
+        st.session_state.thread_id = None
+        st.session_state.pending_file = scenario
 
 # --- MAIN DASHBOARD ---
 col1, col2 = st.columns([1.5, 1])
@@ -85,6 +81,38 @@ with col1:
         else:
             log_container.text(f"  {log}")
 
+    # Stream a freshly started run line by line instead of waiting for the full state
+    if st.session_state.pending_file:
+        final = {}
+
+        def stream_logs():
+            with connect(f"{WS_URL}/stream") as ws:
+                ws.send(json.dumps({"filename": st.session_state.pending_file}))
+                for message in ws:
+                    msg = json.loads(message)
+                    if "status" in msg:
+                        final.update(msg)
+                        break
+                    if "thread_id" in msg:
+                        st.session_state.thread_id = msg["thread_id"]
+                        continue
+                    st.session_state.logs.append(msg["log"])
+                    yield msg["log"] + "\n\n"
+
+        try:
+            with log_container:
+                st.write_stream(stream_logs())
+            st.session_state.status = final.get("status", "FAILED")
+            st.session_state.data = final.get("state") or {
+                "error": final.get("error") or "stream closed before the run finished"
+            }
+        except Exception as e:
+            st.session_state.status = "IDLE"
+            st.error(f"Failed to connect to backend: {e}")
+        st.session_state.pending_file = None
+        if final:
+            st.rerun()
+
 # RIGHT COLUMN: STATE & INTERACTION
 with col2:
     st.subheader("⚙️ Agent State")
@@ -131,7 +159,7 @@ with col2:
                 with st.spinner("Resuming Workflow..."):
                     try:
                         # UPDATED TO MATCH PDF SPEC API
-                        resp = requests.post(f"{API_URL}/human-review/decision", json={
+                        resp = st.session_state.http.post(f"{API_URL}/human-review/decision", json={
                             "checkpoint_id": st.session_state.thread_id, # Mapping thread_id to checkpoint_id
                             "decision": action,
                             "notes": note
@@ -165,6 +193,11 @@ with col2:
             
             st.json(display_payload)
 
+    # --- FAILED STATE (Server Error) ---
+    elif st.session_state.status == "FAILED":
+        st.divider()
+        st.error(f"❌ Workflow stopped: {st.session_state.data.get('error', 'unknown error')}")
+
     # --- IDLE STATE ---
     else:
         st.info("Waiting for input...")
\ No newline at end of file
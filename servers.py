@@ -1,10 +1,15 @@
 import uvicorn
+import asyncio
 import sqlite3
+import threading
 import time
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
 from pydantic import BaseModel
+from typing import List
 from multiprocessing import Process
 import random
+import re
+from cachetools.func import ttl_cache
 
 # --- DATABASE SETUP ---
 def init_erp_db():
@@ -20,45 +25,83 @@ def init_erp_db():
         ("PO-9999", "MEGA CORP", 10000.00, "APPROVED")
     ]
     c.executemany("INSERT OR IGNORE INTO purchase_orders VALUES(?,?,?,?)", data)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_po_vendor ON purchase_orders(vendor)")
     conn.commit() 
     conn.close()
 
 # Initialize DB immediately
 init_erp_db()
 
+# One long-lived connection per server process, opened lazily because the servers
+# are forked after import and a sqlite connection must not cross a fork.
+_erp_conn = None
+_erp_lock = threading.Lock()
+
+def erp_query(sql: str, params: tuple = ()):
+    global _erp_conn
+    with _erp_lock:
+        if _erp_conn is None:
+            _erp_conn = sqlite3.connect("erp_system.db", check_same_thread=False, isolation_level=None)
+            _erp_conn.execute("PRAGMA journal_mode=WAL")
+            _erp_conn.execute("PRAGMA synchronous=NORMAL")
+        return _erp_conn.execute(sql, params).fetchone()
+
 # ==========================================
 # SERVER 1: COMMON (Internal Logic) [Port 8001]
 # ==========================================
+# Endpoints declare a return type, so FastAPI serialises responses to JSON bytes with Pydantic
 common_app = FastAPI(title="COMMON Server")
 
 class MatchRequest(BaseModel):
     invoice_amount: float
     po_amount: float
 
+class BatchRequest(BaseModel):
+    items: List[dict]
+
+def _apply(handler, item: dict) -> dict:
+    # One malformed item must not fail the whole batch, so errors are reported per item
+    try:
+        return {"result": handler(item)}
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+
+def add_batch_route(app: FastAPI, endpoint: str, handler):
+    """Exposes POST /{endpoint}/batch, applying `handler` to each item; results keep item order.
+
+    Each result is {"result": ...} or, if the handler raised for that item, {"error": "..."}.
+    """
+    @app.post(f"/{endpoint}/batch")
+    def batch(req: BatchRequest) -> dict:
+        return {"results": [_apply(handler, item) for item in req.items]}
+
+# Compiled once; a line's last whole-token number is its amount, the last matching line wins
+_AMOUNT_LINE_RE = re.compile(r"^.*(?:amount|total).*$", re.IGNORECASE | re.MULTILINE)
+# A whole token float() accepts once commas are dropped: digits with single underscores,
+# an optional fraction and exponent. nan/inf are deliberately not amounts.
+_DIGITS = r"\d(?:_?\d)*"
+_NUMBER_RE = re.compile(
+    rf"(?<!\S)[-+]?(?:{_DIGITS}(?:\.(?:{_DIGITS})?)?|\.{_DIGITS})(?:[eE][-+]?{_DIGITS})?(?!\S)"
+)
+_VENDOR_LINE_RE = re.compile(r"^.*vendor.*$", re.IGNORECASE | re.MULTILINE)
+
 @common_app.post("/parse_invoice")
-def parse_invoice(text: str):
+def parse_invoice(text: str) -> dict:
     # Heuristic parsing logic
-    lines = text.split('\n')
     extracted = {"amount": 0.0, "vendor": "Unknown", "date": "2024-01-01"}
-    for line in lines:
-        lower = line.lower()
-        if "amount" in lower or "total" in lower:
-            try:
-                words = line.replace('$', '').split()
-                for w in reversed(words):
-                    try:
-                        extracted['amount'] = float(w.replace(',', ''))
-                        break
-                    except: continue
-            except: pass
-
-        if "vendor" in lower:
-            extracted['vendor'] = line.split(":")[-1].strip().upper()
+    for line in _AMOUNT_LINE_RE.findall(text):
+        numbers = _NUMBER_RE.findall(line.replace('$', '').replace(',', ''))
+        if numbers:
+            extracted['amount'] = float(numbers[-1])
+
+    vendors = _VENDOR_LINE_RE.findall(text)
+    if vendors:
+        extracted['vendor'] = vendors[-1].split(":")[-1].strip().upper()
 
     return extracted
 
 @common_app.post("/compute_match_score")
-def compute_match_score(req: MatchRequest):
+def compute_match_score(req: MatchRequest) -> dict:
     if req.po_amount == 0: return {"score": 0.0}
     diff = abs(req.invoice_amount - req.po_amount)
     pct = (diff / req.po_amount) * 100
@@ -66,7 +109,7 @@ def compute_match_score(req: MatchRequest):
     return {"score": round(score, 2)}
 
 @common_app.post("/build_accounting_entries")
-def build_accounting_entries(amount: float, vendor: str):
+def build_accounting_entries(amount: float, vendor: str) -> dict:
     return {
         "entries": [
             {"type": "DEBIT", "account": "EXPENSE_General", "amount": amount},
@@ -74,14 +117,26 @@ def build_accounting_entries(amount: float, vendor: str):
         ]
     }
 
+# Payload adapters (endpoint -> handler(payload dict)), shared by the /batch routes and
+# by the agent's LOCAL_MODE, which calls the tools in-process instead of over HTTP
+COMMON_HANDLERS = {
+    "parse_invoice": lambda p: parse_invoice(**p),
+    "compute_match_score": lambda p: compute_match_score(MatchRequest(**p)),
+    "build_accounting_entries": lambda p: build_accounting_entries(**p),
+}
+
+# Batched variants, used by the agent's BatchingClient under concurrent load
+for _endpoint, _handler in COMMON_HANDLERS.items():
+    add_batch_route(common_app, _endpoint, _handler)
+
 # ==========================================
 # SERVER 2: ATLAS (External Tools) [Port 8002]
 # ==========================================
 atlas_app = FastAPI(title="ATLAS Server")
 
 @atlas_app.post("/ocr_extract")
-def ocr_extract(filename: str, tool: str = "google_vision"):
-    time.sleep(1)
+async def ocr_extract(filename: str, tool: str = "google_vision") -> dict:
+    await asyncio.sleep(1) # Simulate OCR latency without blocking the event loop
     # Demo Logic: Filename dictates content
     if "good" in filename:
         return {"text": "INVOICE #001\nVENDOR: ACME CORP\nTOTAL: $5000.00"}
@@ -94,8 +149,12 @@ def ocr_extract(filename: str, tool: str = "google_vision"):
         
     return {"text": "UNREADABLE"}
 
+# Vendor profiles change on a timescale of days; repeat vendors skip the external API
+ENRICH_CACHE_SECONDS = 3600
+
 @atlas_app.post("/enrich_vendor")
-def enrich_vendor(vendor_name: str):
+@ttl_cache(maxsize=1024, ttl=ENRICH_CACHE_SECONDS)
+def enrich_vendor(vendor_name: str) -> dict:
     time.sleep(0.5) # Simulate API latency
     
     # logic: "Bad" vendors get low scores for the demo
@@ -114,34 +173,56 @@ def enrich_vendor(vendor_name: str):
         "is_sanctioned": False
     }
 
+# PO lookups are idempotent GETs; let HTTP caches/proxies reuse a hit for a short window.
+# Not cached server-side: with the reused WAL connection the lookup is cheap, and a second
+# layer would stretch how long a cached PO can outlive max-age.
+PO_CACHE_SECONDS = 30
+
 @atlas_app.get("/fetch_po")
-def fetch_po(vendor: str):
-    conn = sqlite3.connect("erp_system.db")
-    c = conn.cursor()
-    c.execute("SELECT * FROM purchase_orders WHERE vendor LIKE ?", (f"%{vendor}%",))
-    row = c.fetchone()
-    conn.close()
-    if row: return {"po_number": row[0], "amount": row[2], "found": True}
+def fetch_po(vendor: str, response: Response) -> dict:
+    vendor = vendor.strip().upper()
+    # Exact match uses idx_po_vendor; fall back to the fuzzy scan for partial names
+    row = (erp_query("SELECT po_number, amount FROM purchase_orders WHERE vendor = ?", (vendor,))
+           or erp_query("SELECT po_number, amount FROM purchase_orders WHERE vendor LIKE ?", (f"%{vendor}%",)))
+    if row:
+        response.headers["Cache-Control"] = f"public, max-age={PO_CACHE_SECONDS}"
+        return {"po_number": row[0], "amount": row[1], "found": True}
+    # A PO entered into the ERP must become visible on the next lookup
+    response.headers["Cache-Control"] = "no-store"
     return {"found": False}
 
 @atlas_app.post("/post_to_erp")
-def post_to_erp(invoice_id: str):
+def post_to_erp(invoice_id: str) -> dict:
     return {"erp_txn_id": f"TXN-{int(time.time())}", "status": "POSTED"}
 
 @atlas_app.post("/notify")
-def notify(email: str, message: str):
+def notify(email: str, message: str) -> dict:
     return {"status": "SENT", "provider": "SendGrid"}
 
+ATLAS_HANDLERS = {
+    "ocr_extract": lambda p: ocr_extract(**p),
+    "enrich_vendor": lambda p: enrich_vendor(**p),
+    "fetch_po": lambda p: fetch_po(p["vendor"], Response()),
+    "post_to_erp": lambda p: post_to_erp(**p),
+    "notify": lambda p: notify(**p),
+}
+
+LOCAL_HANDLERS = {**COMMON_HANDLERS, **ATLAS_HANDLERS}
+
 # ==========================================
 # RUNNER 
 # ==========================================
 
+# Keep idle agent connections open longer than the agent's pool expiry (20s), so the
+# agent's keep-alive pool survives gaps between invoices (uvicorn's default is 5s)
+KEEP_ALIVE_SECONDS = 30
+
 # Helper functions to start servers (Fixes pickling error)
 def start_common_server():
-    uvicorn.run(common_app, host="127.0.0.1", port=8001)
+    uvicorn.run(common_app, host="127.0.0.1", port=8001, timeout_keep_alive=KEEP_ALIVE_SECONDS)
 
 def start_atlas_server():
-    uvicorn.run(atlas_app, host="127.0.0.1", port=8002)
+    uvicorn.run(atlas_app, host="127.0.0.1", port=8002, timeout_keep_alive=KEEP_ALIVE_SECONDS)
 
 def run_services():
     # Target functions instead of passing app objects directly
@@ -0,0 +1,126 @@
+import asyncio
+from typing import TypedDict
+
+import httpx
+import orjson
+from langgraph.graph import StateGraph, START, END
+from langgraph.types import interrupt
+
+import agent
+
+
+# --- BatchingClient ---
+def _batch_server(fail_on=()):
+    """Mock COMMON server: echoes each batch item, reporting an error for items in `fail_on`."""
+    calls = []
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        calls.append(request.url.path)
+        items = orjson.loads(request.content)["items"]
+        results = [{"error": "ValueError: bad item"} if item["n"] in fail_on else {"result": {"n": item["n"]}}
+                   for item in items]
+        return httpx.Response(200, json={"results": results})
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handle))
+    return agent.BatchingClient(lambda: client), calls
+
+async def _burst(batcher, n):
+    return await asyncio.gather(
+        *(batcher.post("http://common", "compute_match_score", json={"n": i}) for i in range(n)),
+        return_exceptions=True,
+    )
+
+def test_burst_coalesces_into_one_batch_call():
+    batcher, calls = _batch_server()
+    results = asyncio.run(_burst(batcher, 10))
+    assert results == [{"n": i} for i in range(10)]
+    assert calls == ["/compute_match_score/batch"]
+
+def test_batch_item_error_fails_only_its_caller():
+    batcher, calls = _batch_server(fail_on={3})
+    results = asyncio.run(_burst(batcher, 6))
+    assert isinstance(results[3], agent.TransientServerError)
+    assert [r for i, r in enumerate(results) if i != 3] == [{"n": i} for i in (0, 1, 2, 4, 5)]
+    assert len(calls) == 1
+
+
+# --- _AsyncTTLCache ---
+def test_concurrent_misses_share_one_request():
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return {"found": True}
+
+    async def main():
+        cache = agent._AsyncTTLCache(maxsize=4, ttl=60)
+        results = await asyncio.gather(*(cache.get("ACME CORP", fetch) for _ in range(5)))
+        return results, await cache.get("ACME CORP", fetch)
+
+    results, cached = asyncio.run(main())
+    assert calls == 1
+    assert results == [{"found": True}] * 5 and cached == {"found": True}
+
+def test_po_misses_are_not_cached(monkeypatch):
+    lookups = []
+
+    async def fake_get(url, endpoint, params=None):
+        lookups.append(params["vendor"])
+        return {"found": False}
+
+    agent.cache_clear()
+    monkeypatch.setattr(agent, "call_get", fake_get)
+
+    async def main():
+        await agent.fetch_po_cached("NEW VENDOR")
+        await agent.fetch_po_cached("NEW VENDOR")
+
+    asyncio.run(main())
+    assert lookups == ["NEW VENDOR", "NEW VENDOR"]
+
+
+# --- EvictingSqliteSaver ---
+class _ReviewState(TypedDict):
+    needs_review: bool
+
+def _review_graph(saver):
+    def review(state):
+        if state["needs_review"]:
+            interrupt("review")
+        return {}
+
+    builder = StateGraph(_ReviewState)
+    builder.add_node("review", review)
+    builder.add_edge(START, "review")
+    builder.add_edge("review", END)
+    return builder.compile(checkpointer=saver)
+
+def _config(thread_id):
+    return {"configurable": {"thread_id": thread_id}}
+
+async def _age(saver, seconds):
+    async with saver.lock:
+        await saver.conn.execute("UPDATE thread_activity SET updated_at = updated_at - ?", (seconds,))
+        await saver.conn.commit()
+
+def test_evict_stale_keeps_paused_threads_until_paused_max_age(tmp_path):
+    async def main():
+        async with agent.sqlite_checkpointer(str(tmp_path / "checkpoints.db"), interval=3600) as saver:
+            graph = _review_graph(saver)
+            await graph.ainvoke({"needs_review": True}, _config("paused"))
+            await graph.ainvoke({"needs_review": False}, _config("finished"))
+
+            await _age(saver, 120)
+            first = await saver.evict_stale(max_age=60, paused_max_age=3600)
+            paused = await saver.aget_tuple(_config("paused"))
+            finished = await saver.aget_tuple(_config("finished"))
+
+            await _age(saver, 7200)
+            second = await saver.evict_stale(max_age=60, paused_max_age=3600)
+            return first, paused, finished, second, await saver.aget_tuple(_config("paused"))
+
+    first, paused, finished, second, paused_after = asyncio.run(main())
+    assert first == 1 and paused is not None and finished is None
+    assert second == 1 and paused_after is None